@@ -19,6 +19,7 @@ import multiprocessing
 import pandas as pd
 import os
 from typing import List, Dict, Tuple, Optional
+from esp_text_replacement_module import compile_esperanto_char_conversion, apply_esperanto_char_conversion
 
 #=================================================================
 # 1) エスペラント文字変換用の辞書 (同様のものが他のファイルにもある)
@@ -44,11 +45,13 @@ def replace_esperanto_chars(text, char_dict: Dict[str, str]) -> str:
         text = text.replace(original_char, converted_char)
     return text
 
+# convert_to_circumflex 用 (hat_to_circumflex → x_to_circumflex の順に replace するのと同じ結果)
+TO_CIRCUMFLEX_CONVERSION = compile_esperanto_char_conversion(hat_to_circumflex, x_to_circumflex)
+
 def convert_to_circumflex(text: str) -> str:
     # c^, g^... → ĉ, ĝ...  および cx, gx... → ĉ, ĝ... に変換
-    text = replace_esperanto_chars(text, hat_to_circumflex)
-    text = replace_esperanto_chars(text, x_to_circumflex)
-    return text
+    # (translate 用の表 + 1つの正規表現で、テキストを1回走査するだけで変換する)
+    return apply_esperanto_char_conversion(text, TO_CIRCUMFLEX_CONVERSION)
 
 #=================================================================
 # 3) 文字幅計測 & <br> 挿入関数
@@ -293,7 +296,8 @@ def parallel_build_pre_replacements_dict(
         if start_index >= total_len:
             break
 
-    with multiprocessing.Pool(num_processes) as pool:
+    # main.py を経由せずに呼ばれても fork しないよう、spawn を明示する
+    with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
         partial_dicts = pool.starmap(
             process_chunk_for_pre_replacements,
             [(chunk, replacements) for chunk in chunks]
@@ -7,16 +7,26 @@
 1. エスペラント独自の文字形式（ĉ, ĝなど）への変換 → convert_to_circumflex
 2. 特殊な半角スペースの統一（ASCIIスペースに） → unify_halfwidth_spaces
 3. (現在不要になった) HTMLルビ付与関数 → wrap_text_with_ruby (コメントのみ)
-4. %や@で囲まれたテキストのスキップ・局所変換 → (create_replacements_list_for_...)
+4. %や@で囲まれたテキストのスキップ・局所変換 → split_protected_segments
 5. 大域的なプレースホルダー置換 → safe_replace
 6. それらをまとめて実行する複合置換関数 → orchestrate_comprehensive_esperanto_text_replacement
-7. multiprocessing を用いた行単位の並列実行 → parallel_process / process_segment
+   (大域置換の候補は Aho–Corasick オートマトンで事前に絞り込む → build_replacement_automaton)
+   (大域置換は行の境界で区切ったブロックごとに行う → replace_unprotected_segment)
+7. multiprocessing を用いた(行の境界で分割した)並列実行 → parallel_process / process_segment
+   (置換用データを読み込み済みのワーカープールを使い回す → create_replacement_process_pool)
 """
 
+import os
 import re
 import json
-from typing import List, Tuple, Dict
+import pickle
+import weakref
+import bisect
+from typing import List, Tuple, Dict, Optional, NamedTuple, Union
 import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor
+import ahocorasick
 
 # ================================
 # 1) エスペラント文字変換用の辞書
@@ -57,15 +67,67 @@ def replace_esperanto_chars(text, char_dict: Dict[str, str]) -> str:
         text = text.replace(original_char, converted_char)
     return text
 
+# 1文字→文字列 の変換は str.translate 用の表に、2文字以上の変換は1つの正規表現にまとめる
+CharConversion = Tuple[Dict[int, str], Optional[re.Pattern], Dict[str, str]]
+
+def compile_esperanto_char_conversion(*char_dicts: Dict[str, str]) -> CharConversion:
+    """
+    複数の文字変換辞書を1つにまとめ、(translate用の表, 正規表現, 2文字以上の変換辞書) を返す。
+    各辞書を順に replace_esperanto_chars する場合と結果が同じになるのは、
+    ある辞書の変換結果が他の辞書の変換元を作り出さない場合 (このモジュールの辞書の組み合わせ) に限る。
+    """
+    translate_table = {}
+    multi_char_mapping = {}
+    for char_dict in char_dicts:
+        for original_char, converted_char in char_dict.items():
+            if len(original_char) == 1:
+                translate_table[ord(original_char)] = converted_char
+            else:
+                multi_char_mapping[original_char] = converted_char
+    pattern = None
+    if multi_char_mapping:
+        pattern = re.compile('|'.join(
+            re.escape(original_char)
+            for original_char in sorted(multi_char_mapping, key=len, reverse=True)
+        ))
+    return translate_table, pattern, multi_char_mapping
+
+def apply_esperanto_char_conversion(text: str, conversion: CharConversion) -> str:
+    """compile_esperanto_char_conversion の結果を使い、translate 1回 + 正規表現1回で変換する。"""
+    translate_table, pattern, multi_char_mapping = conversion
+    if translate_table:
+        text = text.translate(translate_table)
+    if pattern is not None:
+        text = pattern.sub(lambda m: multi_char_mapping[m.group(0)], text)
+    return text
+
+# convert_to_circumflex 用 (hat_to_circumflex → x_to_circumflex の順に変換するのと同じ結果)
+TO_CIRCUMFLEX_CONVERSION = compile_esperanto_char_conversion(hat_to_circumflex, x_to_circumflex)
+
+# 出力文字形式 (letter_type) ごとの変換。'x 形式' は変換しない。
+LETTER_TYPE_CONVERSIONS = {
+    '上付き文字': compile_esperanto_char_conversion(x_to_circumflex, hat_to_circumflex),
+    '^形式': compile_esperanto_char_conversion(x_to_hat, circumflex_to_hat),
+}
+
+def convert_esperanto_letter_type(text: str, letter_type: str) -> str:
+    """
+    置換結果のエスペラント特有文字を、letter_type で指定された表記に統一する。
+    (x_to_circumflex → hat_to_circumflex のように2回 replace_esperanto_chars するのと同じ結果)
+    """
+    conversion = LETTER_TYPE_CONVERSIONS.get(letter_type)
+    if conversion is None:
+        return text
+    return apply_esperanto_char_conversion(text, conversion)
+
 def convert_to_circumflex(text: str) -> str:
     """
     テキストを字上符形式（ĉ, ĝ, ĥ, ĵ, ŝ, ŭなど）に統一します。
     1. hat_to_circumflex: c^ → ĉ
     2. x_to_circumflex: cx → ĉ
+    (1, 2 は1つの正規表現でまとめて1回で変換する)
     """
-    text = replace_esperanto_chars(text, hat_to_circumflex)
-    text = replace_esperanto_chars(text, x_to_circumflex)
-    return text
+    return apply_esperanto_char_conversion(text, TO_CIRCUMFLEX_CONVERSION)
 
 def unify_halfwidth_spaces(text: str) -> str:
     """
@@ -110,142 +172,409 @@ def import_placeholders(filename: str) -> List[str]:
         placeholders = [line.strip() for line in file if line.strip()]
     return placeholders
 
-# '%' で囲まれた箇所をスキップするための正規表現
+# '%' で囲まれた箇所をスキップするための正規表現 (50文字以内に限定)
 PERCENT_PATTERN = re.compile(r'%(.{1,50}?)%')
-def find_percent_enclosed_strings_for_skipping_replacement(text: str) -> List[str]:
-    """'%foo%' の形を全て抽出。50文字以内に限定。"""
-    matches = []
-    used_indices = set()
-    for match in PERCENT_PATTERN.finditer(text):
-        start, end = match.span()
-        if start not in used_indices and end-2 not in used_indices:
-            matches.append(match.group(1))
-            used_indices.update(range(start, end))
-    return matches
-
-def create_replacements_list_for_intact_parts(text: str, placeholders: List[str]) -> List[Tuple[str, str]]:
-    """
-    '%xxx%' で囲まれた箇所を検出し、
-    ( '%xxx%', placeholder ) という形で対応させるリストを作る
-    """
-    matches = find_percent_enclosed_strings_for_skipping_replacement(text)
-    replacements_list_for_intact_parts = []
-    for i, match in enumerate(matches):
-        if i < len(placeholders):
-            replacements_list_for_intact_parts.append([f"%{match}%", placeholders[i]])
-        else:
-            break
-    return replacements_list_for_intact_parts
-
-# '@' で囲まれた箇所を局所置換するための正規表現
+# '@' で囲まれた箇所を局所置換するための正規表現 (18文字以内に限定)
 AT_PATTERN = re.compile(r'@(.{1,18}?)@')
-def find_at_enclosed_strings_for_localized_replacement(text: str) -> List[str]:
-    """'@foo@' の形を全て抽出。18文字以内に限定。"""
-    matches = []
-    used_indices = set()
-    for match in AT_PATTERN.finditer(text):
-        start, end = match.span()
-        if start not in used_indices and end-2 not in used_indices:
-            matches.append(match.group(1))
-            used_indices.update(range(start, end))
-    return matches
-
-def create_replacements_list_for_localized_replacement(text, placeholders: List[str],
-                                                       replacements_list_for_localized_string: List[Tuple[str, str, str]]
-                                                       ) -> List[List[str]]:
-    """
-    '@xxx@' で囲まれた箇所を検出し、
-    その内部文字列 'xxx' を replacements_list_for_localized_string で置換した結果を
-    placeholder に置き換える。
-    """
-    matches = find_at_enclosed_strings_for_localized_replacement(text)
-    tmp_list = []
-    for i, match in enumerate(matches):
-        if i < len(placeholders):
-            replaced_match = safe_replace(match, replacements_list_for_localized_string)
-            tmp_list.append([f"@{match}@", placeholders[i], replaced_match])
-        else:
+
+# ================================
+# 4.5) 大域置換の候補絞り込み (Aho–Corasick)
+# ================================
+# 大域置換リスト(30万件程度)を1件ずつ `old in text` で調べると、
+# テキスト長 × ルール数 の走査になる。そこで全ルールの old を1つの
+# Aho–Corasick オートマトンにまとめ、テキストを1回走査するだけで
+# 「テキスト中に出現する old を持つルール」の番号を集める。
+# 置換そのものは従来通りリストの優先順位順に行うので、結果は変わらない。
+#
+# ※ 置換の途中で old が「新たに」出現するのは、その出現が置換で新たに現れた文字列と重なる場合だけ。
+#   新たに現れる文字列は、プレースホルダから「置換された old と共通の先頭・末尾」を除いた部分
+#   (' al ' → ' $15246$ ' なら '$15246$'。共通の空白はもともとテキストにあった文字) で、
+#   ここではそれを「プレースホルダの核」と呼ぶ。old が (1) 核の一部分である、(2) 核を含む、
+#   (3) 末尾が核の先頭部分と一致する、(4) 先頭が核の末尾部分と一致する のいずれかなら、
+#   そのルールは (JSON のプレースホルダの形に関係なく) 常に候補として扱う。
+
+# 大域置換リストは (old, new, placeholder) の tuple を30万件並べる代わりに、
+# old / new / placeholder の列ごとの tuple 3つで持てる (1件ごとの tuple オブジェクトが要らない分、
+# メモリが少なく、ワーカーへ渡すときの pickle も速い)。
+class ReplacementColumns(NamedTuple):
+    olds: Tuple[str, ...]
+    news: Tuple[str, ...]
+    placeholders: Tuple[str, ...]
+
+# 大域置換リストとして受け付ける形 ((old, new, placeholder) のリスト、または ReplacementColumns)
+FinalReplacements = Union[List[Tuple[str, str, str]], ReplacementColumns]
+
+def as_replacement_columns(replacements: FinalReplacements) -> ReplacementColumns:
+    """
+    (old, new, placeholder) のリストを ReplacementColumns に変換する (すでに変換済みならそのまま返す)。
+    """
+    if isinstance(replacements, ReplacementColumns):
+        return replacements
+    if not replacements:
+        return ReplacementColumns((), (), ())
+    return ReplacementColumns(*map(tuple, zip(*replacements)))
+
+# (オートマトン, 常に候補として扱うルール番号のタプル)
+ReplacementAutomaton = Tuple[ahocorasick.Automaton, Tuple[int, ...]]
+
+def build_replacement_automaton(replacements_final_list: FinalReplacements) -> ReplacementAutomaton:
+    """
+    replacements_final_list の old をキー、ルール番号のタプルを値とする
+    Aho–Corasick オートマトンを作る。
+    """
+    olds, _, placeholders = as_replacement_columns(replacements_final_list)
+    automaton = ahocorasick.Automaton()
+    always_candidate_indices = set()
+    for index, old in enumerate(olds):
+        if not old:
+            always_candidate_indices.add(index)
+            continue
+        automaton.add_word(old, automaton.get(old, ()) + (index,))
+    automaton.make_automaton()
+
+    placeholder_cores = list({
+        get_placeholder_core(old, placeholder) for old, placeholder in zip(olds, placeholders)
+    } - {''})
+    if placeholder_cores and automaton.kind == ahocorasick.AHOCORASICK:
+        # (1) 核の一部分になっている old
+        #     (区切りの改行をまたぐ一致は余分に候補になるだけなので構わない)
+        for _, rule_indices in automaton.iter('\n'.join(placeholder_cores)):
+            always_candidate_indices.update(rule_indices)
+        always_candidate_indices.update(find_core_overlapping_indices(olds, placeholder_cores))
+    return automaton, tuple(sorted(always_candidate_indices))
+
+def get_placeholder_core(old: str, placeholder: str) -> str:
+    """
+    placeholder から old と共通の先頭・末尾を除いた部分 (置換で新たに現れる文字列) を返す。
+    核は1文字以上残す (共通部分を除くと空になる場合は、その分だけ共通部分を短くする)。
+    """
+    if not old or (old[0] != placeholder[:1] and old[-1] != placeholder[-1:]):
+        return placeholder
+    limit = min(len(old), len(placeholder) - 1)
+    prefix_length = 0
+    while prefix_length < limit and old[prefix_length] == placeholder[prefix_length]:
+        prefix_length += 1
+    suffix_length = 0
+    while (prefix_length + suffix_length < limit
+           and old[-1 - suffix_length] == placeholder[-1 - suffix_length]):
+        suffix_length += 1
+    return placeholder[prefix_length:len(placeholder) - suffix_length]
+
+def find_core_overlapping_indices(olds: Tuple[str, ...], placeholder_cores: List[str]) -> List[int]:
+    """
+    核を含む old、または先頭・末尾が核の末尾・先頭と重なりうる old の番号を返す。
+    ((2)〜(4) の判定。核の最初・最後の文字を含まない old はそもそも調べない)
+    """
+    first_chars = {core[0] for core in placeholder_cores}
+    last_chars = {core[-1] for core in placeholder_cores}
+    suspects = [
+        (index, old) for index, old in enumerate(olds)
+        if not (first_chars.isdisjoint(old) and last_chars.isdisjoint(old))
+    ]
+    if not suspects:
+        return []
+
+    # 核を探すオートマトンと、(末尾部分を前方一致で調べるための) 逆順の核の trie
+    core_automaton = ahocorasick.Automaton()
+    reversed_core_trie = ahocorasick.Automaton()
+    for core in placeholder_cores:
+        core_automaton.add_word(core, core)
+        reversed_core_trie.add_word(core[::-1], core)
+    core_automaton.make_automaton()
+
+    indices = []
+    for index, old in suspects:
+        if (
+            # (2) 核を含む
+            next(core_automaton.iter(old), None) is not None
+            # (3) old[k:] が核の先頭部分
+            or any(old[k] in first_chars and core_automaton.match(old[k:]) for k in range(1, len(old)))
+            # (4) old[:k] が核の末尾部分
+            or any(old[k - 1] in last_chars and reversed_core_trie.match(old[:k][::-1])
+                   for k in range(1, len(old)))
+        ):
+            indices.append(index)
+    return indices
+
+def find_candidate_replacement_indices_by_block(
+    text: str,
+    block_ends: List[int],
+    replacement_automaton: ReplacementAutomaton
+) -> List[List[int]]:
+    """
+    text を block_ends (各ブロックの終了位置, 昇順) で区切ったブロックごとに、
+    そのブロック内に old が出現するルールの番号をリストの順番(=優先順位)で返す。
+    オートマトンでの走査は text 全体に対して1回だけ行う。
+    """
+    automaton, always_candidate_indices = replacement_automaton
+    indices_by_block = [set(always_candidate_indices) for _ in block_ends]
+    if automaton.kind == ahocorasick.AHOCORASICK:
+        for end_index, rule_indices in automaton.iter(text):
+            # end_index は一致した部分の最後の文字の位置。ルールは改行をまたがないので、
+            # 一致した部分は必ず1つのブロックに収まる。
+            indices_by_block[bisect.bisect_right(block_ends, end_index)].update(rule_indices)
+    return [sorted(indices) for indices in indices_by_block]
+
+# 大域置換のプレースホルダ ('$20897$', '$20897up$', '$20897cap$' の前後に空白が付く場合もある) の形。
+# 走査用の方を先読みにしているのは、'$' を1文字ずつずらしながら候補を探すため
+# (テキスト中の '$' とプレースホルダが隣り合っていても取りこぼさない)。
+GLOBAL_PLACEHOLDER_PATTERN = re.compile(r'\$\d+(?:up|cap)?\$')
+GLOBAL_PLACEHOLDER_SCAN_PATTERN = re.compile(r'\$(?=(\d+(?:up|cap)?\$))')
+
+def restore_placeholders(text: str, valid_replacements: Dict[str, str]) -> str:
+    """
+    text 中のプレースホルダ (valid_replacements のキー) を、1回の走査で対応する文字列に戻す。
+    プレースホルダごとに text.replace するとプレースホルダ数 × テキスト長 の走査になるため、
+    1つのコンパイル済み正規表現で '$...$' の部分を拾い、dict で引いて置き換える。
+
+    前後に空白の付いたプレースホルダ ('$21249$ ' など) は、置換後の文字列にも同じ空白が付いているので、
+    両方から空白を除いた '$...$' → 文字列 の対応として扱う。
+    (1つずつ replace する場合、隣のプレースホルダと共有している空白は先に戻した側の
+    置換後の文字列から供給されるので、空白を除いて置き換えても結果は同じになる)
+    キーがこの形でない場合は従来通り1つずつ replace する。
+    """
+    # '$...$' の部分 → 置換後の文字列 (前後の空白を除いたもの)
+    core_replacements = {}
+    for placeholder, new in valid_replacements.items():
+        core = placeholder.strip(' ')
+        leading = len(placeholder) - len(placeholder.lstrip(' '))
+        trailing = len(placeholder) - len(placeholder.rstrip(' '))
+        if (not GLOBAL_PLACEHOLDER_PATTERN.fullmatch(core) or core in core_replacements
+                or not new.startswith(' ' * leading) or not new.endswith(' ' * trailing)
+                or len(new) < leading + trailing):
+            core_replacements = None
             break
-    return tmp_list
+        core_replacements[core] = new[leading:len(new) - trailing]
+    if core_replacements is None:
+        for placeholder, new in valid_replacements.items():
+            text = text.replace(placeholder, new)
+        return text
+
+    parts = []
+    last_end = 0
+    for match in GLOBAL_PLACEHOLDER_SCAN_PATTERN.finditer(text):
+        start = match.start()
+        if start < last_end:
+            continue
+        core = '$' + match.group(1)
+        new = core_replacements.get(core)
+        if new is None:
+            continue
+        parts.append(text[last_end:start])
+        parts.append(new)
+        last_end = start + len(core)
+    parts.append(text[last_end:])
+    return ''.join(parts)
 
 # ================================
 # 5) メインの複合文字列(漢字)置換関数
 # ================================
+def split_protected_segments(
+    text: str,
+    placeholders_for_skipping_replacements: List[str],
+    placeholders_for_localized_replacement: List[str],
+    replacements_list_for_localized_string: List[Tuple[str, str, str]]
+) -> List[Tuple[bool, str]]:
+    """
+    text を「置換対象の部分」と「%...% / @...@ で保護された部分」に分け、
+    (保護された部分かどうか, 文字列) のリストを返す。
+    保護された部分は最終的な出力 (%...% は中身そのまま、@...@ は局所置換の結果) にしておく。
+
+    プレースホルダをテキストに埋め込んで置換後に戻す代わりに、検出した範囲の位置だけを使って
+    テキストを1回で切り分ける。プレースホルダ文字列は、件数の上限と、
+    @...@ の文字数制限(18文字)を従来通り「%...% をプレースホルダに置き換えた後のテキスト」
+    で判定するためにだけ使う。
+    """
+    # 3) %...% : masked は %...% を対応するプレースホルダに置き換えたテキスト
+    #    skip_spans は masked 上の (開始, 終了, プレースホルダ, 出力する文字列)
+    skip_spans = []
+    masked_parts = []
+    masked_length = 0
+    last_end = 0
+    placeholder_by_original = {}
+    for i, match in enumerate(PERCENT_PATTERN.finditer(text)):
+        if i >= len(placeholders_for_skipping_replacements):
+            break
+        original = match.group(0)
+        placeholder = placeholder_by_original.setdefault(original, placeholders_for_skipping_replacements[i])
+        plain = text[last_end:match.start()]
+        masked_parts.append(plain)
+        masked_parts.append(placeholder)
+        masked_length += len(plain)
+        skip_spans.append((masked_length, masked_length + len(placeholder), placeholder, original.replace("%", "")))
+        masked_length += len(placeholder)
+        last_end = match.end()
+    if not skip_spans:
+        masked = text
+    else:
+        masked_parts.append(text[last_end:])
+        masked = ''.join(masked_parts)
+
+    segments = []
+    span_index = 0
+
+    def append_unprotected(start: int, end: int) -> None:
+        # masked[start:end] を、その中の %...% で区切って segments に追加する
+        nonlocal span_index
+        while span_index < len(skip_spans) and skip_spans[span_index][0] < end:
+            span_start, span_end, _, intact = skip_spans[span_index]
+            if start < span_start:
+                segments.append((False, masked[start:span_start]))
+            segments.append((True, intact))
+            start = span_end
+            span_index += 1
+        if start < end:
+            segments.append((False, masked[start:end]))
+
+    # 4) @...@ : masked 上で検出し、中身を局所置換した結果を保護された部分にする
+    last_end = 0
+    for i, match in enumerate(AT_PATTERN.finditer(masked)):
+        if i >= len(placeholders_for_localized_replacement):
+            break
+        append_unprotected(last_end, match.start())
+        localized = safe_replace(match.group(1), replacements_list_for_localized_string).replace("@", "")
+        # @...@ の内側にある %...% は、中身をそのまま戻す
+        while span_index < len(skip_spans) and skip_spans[span_index][0] < match.end():
+            _, _, placeholder, intact = skip_spans[span_index]
+            localized = localized.replace(placeholder, intact)
+            span_index += 1
+        segments.append((True, localized))
+        last_end = match.end()
+    append_unprotected(last_end, len(masked))
+    return segments
+
+# 5), 6) の置換を行うブロックのおおよその文字数 (ブロックの境界は改行の直後)
+REPLACEMENT_BLOCK_SIZE = 2048
+
+def replace_unprotected_segment(
+    text: str,
+    replacements_final_list: FinalReplacements,
+    replacements_list_for_2char: List[Tuple[str, str, str]],
+    replacement_automaton: Optional[ReplacementAutomaton] = None
+) -> str:
+    """
+    %...% / @...@ で保護されていない部分に、大域置換と2文字語根置換を行う。
+    (orchestrate_comprehensive_esperanto_text_replacement の 5)〜7))
+
+    replacement_automaton がある場合、5), 6) は text を行の境界で区切った
+    REPLACEMENT_BLOCK_SIZE 文字程度のブロックごとに、そのブロックに出現するルールだけで行う。
+    置換ルールもプレースホルダも改行をまたがないので、text 全体への str.replace は
+    ブロックごとの str.replace を繋げたものと同じになる。1回の replace がテキスト全体ではなく
+    ブロックだけを走査するので、(ルール数 × テキスト長) の走査を避けられる。
+    7) の復元は、どのブロックで使われたかに関係なくリストの順番でまとめ直してから text 全体に行う。
+    """
+    olds, news, placeholders = as_replacement_columns(replacements_final_list)
+    if replacement_automaton is None:
+        blocks = [text]
+        candidate_indices_by_block = [range(len(olds))]
+    else:
+        blocks = split_text_into_line_aligned_chunks(text, max(len(text) // REPLACEMENT_BLOCK_SIZE, 1))
+        block_ends = []
+        block_end = 0
+        for block in blocks:
+            block_end += len(block)
+            block_ends.append(block_end)
+        candidate_indices_by_block = find_candidate_replacement_indices_by_block(
+            text, block_ends, replacement_automaton
+        )
+
+    # 置換が行われたルールの番号 (大域置換, 2文字語根置換1回目, 2回目)
+    used_final_indices = set()
+    used_2char_indices = set()
+    used_2char_indices_2 = set()
+    replaced_blocks = []
+    for block, candidate_indices in zip(blocks, candidate_indices_by_block):
+        # 5) 大域置換 (old, new, placeholder)
+        for i in candidate_indices:
+            old = olds[i]
+            if old in block:
+                block = block.replace(old, placeholders[i])
+                used_final_indices.add(i)
+
+        # 6) 2文字語根置換(2回)
+        for i, (old, _, placeholder) in enumerate(replacements_list_for_2char):
+            if old in block:
+                block = block.replace(old, placeholder)
+                used_2char_indices.add(i)
+
+        for i, (old, _, placeholder) in enumerate(replacements_list_for_2char):
+            if old in block:
+                block = block.replace(old, "!" + placeholder + "!")
+                used_2char_indices_2.add(i)
+        replaced_blocks.append(block)
+    text = ''.join(replaced_blocks)
+
+    # 置換後の文字列への対応を、リストの順番 (全体を1回で置換した場合と同じ順番) で作る
+    valid_replacements = {}
+    for i in sorted(used_final_indices):
+        valid_replacements[placeholders[i]] = news[i]
+
+    valid_replacements_for_2char_roots = {}
+    for i in sorted(used_2char_indices):
+        _, new, placeholder = replacements_list_for_2char[i]
+        valid_replacements_for_2char_roots[placeholder] = new
+
+    valid_replacements_for_2char_roots_2 = {}
+    for i in sorted(used_2char_indices_2):
+        _, new, placeholder = replacements_list_for_2char[i]
+        valid_replacements_for_2char_roots_2["!" + placeholder + "!"] = new
+
+    # 7) placeholderを最終的な文字列に戻す
+    for place_holder_second, new in reversed(valid_replacements_for_2char_roots_2.items()):
+        text = text.replace(place_holder_second, new)
+
+    for placeholder, new in reversed(valid_replacements_for_2char_roots.items()):
+        text = text.replace(placeholder, new)
+
+    return restore_placeholders(text, valid_replacements)
+
 def orchestrate_comprehensive_esperanto_text_replacement(
     text, 
     placeholders_for_skipping_replacements: List[str],
     replacements_list_for_localized_string: List[Tuple[str, str, str]],
     placeholders_for_localized_replacement: List[str],
-    replacements_final_list: List[Tuple[str, str, str]],
+    replacements_final_list: FinalReplacements,
     replacements_list_for_2char: List[Tuple[str, str, str]],
-    format_type: str
+    format_type: str,
+    replacement_automaton: Optional[ReplacementAutomaton] = None
 ) -> str:
     """
     複数の変換ルールに従ってエスペラント文を文字列(漢字)置換するメイン関数。
+    replacement_automaton (build_replacement_automaton の戻り値) を渡すと、
+    5) の大域置換はテキスト中に出現するルールだけを対象にする。
 
     1) 空白の正規化 → 2) エスペラント文字(ĉ等)の字上符形式統一
     3) %で囲まれた部分をスキップ
     4) @で囲まれた部分を局所置換
+       (3, 4 は split_protected_segments でテキストを切り分けるだけで、プレースホルダは埋め込まない)
     5) 大域置換
     6) 2文字語根の置換を2回
     7) プレースホルダ復元
+       (5〜7 は保護されていない部分ごとに replace_unprotected_segment で行う)
     8) HTML形式が指定なら追加整形
     """
     # 1, 2) 空白の正規化 + エスペラント字上符への変換
     text = unify_halfwidth_spaces(text)
     text = convert_to_circumflex(text)
 
-    # 3) %...% スキップ部の一時置換
-    replacements_list_for_intact_parts = create_replacements_list_for_intact_parts(text, placeholders_for_skipping_replacements)
-    # 文字数長い順にsort (衝突を避けるため)
-    sorted_replacements_list_for_intact_parts = sorted(replacements_list_for_intact_parts, key=lambda x: len(x[0]), reverse=True)
-    for original, place_holder_ in sorted_replacements_list_for_intact_parts:
-        text = text.replace(original, place_holder_)
+    # 大域置換リストは列ごとの形にしておく (セグメントごとに変換し直さないように)
+    replacements_final_list = as_replacement_columns(replacements_final_list)
 
-    # 4) @...@ 局所置換
-    tmp_replacements_list_for_localized_string_2 = create_replacements_list_for_localized_replacement(
-        text, placeholders_for_localized_replacement, replacements_list_for_localized_string
+    # 3, 4) %...% スキップ部 / @...@ 局所置換部 を切り分ける
+    segments = split_protected_segments(
+        text,
+        placeholders_for_skipping_replacements,
+        placeholders_for_localized_replacement,
+        replacements_list_for_localized_string
     )
-    sorted_replacements_list_for_localized_string = sorted(tmp_replacements_list_for_localized_string_2, key=lambda x: len(x[0]), reverse=True)
-    for original, place_holder_, replaced_original in sorted_replacements_list_for_localized_string:
-        text = text.replace(original, place_holder_)
 
-    # 5) 大域置換 (old, new, placeholder)
-    valid_replacements = {}
-    for old, new, placeholder in replacements_final_list:
-        if old in text:
-            text = text.replace(old, placeholder)
-            valid_replacements[placeholder] = new
-
-    # 6) 2文字語根置換(2回)
-    valid_replacements_for_2char_roots = {}
-    for old, new, placeholder in replacements_list_for_2char:
-        if old in text:
-            text = text.replace(old, placeholder)
-            valid_replacements_for_2char_roots[placeholder] = new
-
-    valid_replacements_for_2char_roots_2 = {}
-    for old, new, placeholder in replacements_list_for_2char:
-        if old in text:
-            place_holder_second = "!" + placeholder + "!"
-            text = text.replace(old, place_holder_second)
-            valid_replacements_for_2char_roots_2[place_holder_second] = new
-
-    # 7) placeholderを最終的な文字列に戻す
-    for place_holder_second, new in reversed(valid_replacements_for_2char_roots_2.items()):
-        text = text.replace(place_holder_second, new)
-
-    for placeholder, new in reversed(valid_replacements_for_2char_roots.items()):
-        text = text.replace(placeholder, new)
-
-    for placeholder, new in valid_replacements.items():
-        text = text.replace(placeholder, new)
-
-    # 局所(@)・スキップ(%) の復元
-    for original, place_holder_, replaced_original in sorted_replacements_list_for_localized_string:
-        text = text.replace(place_holder_, replaced_original.replace("@",""))
-    for original, place_holder_ in sorted_replacements_list_for_intact_parts:
-        text = text.replace(place_holder_, original.replace("%",""))
+    # 5〜7) 保護されていない部分だけを置換し、元の順番で結合
+    text = ''.join(
+        segment if is_protected else replace_unprotected_segment(
+            segment, replacements_final_list, replacements_list_for_2char, replacement_automaton
+        )
+        for is_protected, segment in segments
+    )
 
     # 8) HTML形式であれば、改行を <br> に変換 + スペースを &nbsp; に置換
     if "HTML" in format_type:
@@ -265,9 +594,10 @@ def process_segment(
     placeholders_for_skipping_replacements: List[str],
     replacements_list_for_localized_string: List[Tuple[str, str, str]],
     placeholders_for_localized_replacement: List[str],
-    replacements_final_list: List[Tuple[str, str, str]],
+    replacements_final_list: FinalReplacements,
     replacements_list_for_2char: List[Tuple[str, str, str]],
-    format_type: str
+    format_type: str,
+    replacement_automaton: Optional[ReplacementAutomaton] = None
 ) -> str:
     """
     multiprocessing用の下請け関数。
@@ -281,24 +611,162 @@ def process_segment(
         placeholders_for_localized_replacement,
         replacements_final_list,
         replacements_list_for_2char,
-        format_type
+        format_type,
+        replacement_automaton
     )
     return result
 
 
+# ワーカープロセス側で保持する置換用データ (init_replacement_worker で設定)
+_worker_replacement_args: Optional[Tuple] = None
+
+def init_replacement_worker(shm_name: Optional[str], size: int, payload: Optional[bytes] = None) -> None:
+    """
+    ProcessPoolExecutor の initializer。
+    親プロセスが共有メモリに書き込んだ置換用データ (pickle) をワーカー起動時に1回だけ読み込み、
+    モジュールのグローバル変数に保持する。
+    共有メモリを使えなかった場合は、shm_name を None にして pickle 済みの payload を直接渡す。
+    """
+    global _worker_replacement_args
+    if shm_name is None:
+        _worker_replacement_args = pickle.loads(payload)
+        return
+    shm = SharedMemory(name=shm_name)
+    try:
+        with shm.buf[:size] as view:
+            _worker_replacement_args = pickle.loads(view)
+    finally:
+        shm.close()
+
+def process_segment_in_worker(segment: str, format_type: str) -> str:
+    """
+    ワーカープール用の下請け関数。置換用データはワーカーが保持しているものを使うので、
+    呼び出しごとに送られるのは segment と format_type だけ。
+    """
+    (placeholders_for_skipping_replacements,
+     replacements_list_for_localized_string,
+     placeholders_for_localized_replacement,
+     replacements_final_list,
+     replacements_list_for_2char,
+     replacement_automaton) = _worker_replacement_args
+    return orchestrate_comprehensive_esperanto_text_replacement(
+        segment,
+        placeholders_for_skipping_replacements,
+        replacements_list_for_localized_string,
+        placeholders_for_localized_replacement,
+        replacements_final_list,
+        replacements_list_for_2char,
+        format_type,
+        replacement_automaton
+    )
+
+def create_replacement_process_pool(
+    num_processes: int,
+    placeholders_for_skipping_replacements: List[str],
+    replacements_list_for_localized_string: List[Tuple[str, str, str]],
+    placeholders_for_localized_replacement: List[str],
+    replacements_final_list: FinalReplacements,
+    replacements_list_for_2char: List[Tuple[str, str, str]],
+    replacement_automaton: Optional[ReplacementAutomaton] = None
+) -> ProcessPoolExecutor:
+    """
+    置換用データを読み込み済みのワーカーを持つ ProcessPoolExecutor を作る。
+    呼び出し側でキャッシュして使い回せば、実行の度にプロセス起動や
+    置換用リストの pickle をやり直さずに済む。
+    置換用データは1回だけ pickle して共有メモリに置き、ワーカーには共有メモリの名前だけを渡す。
+    共有メモリはプールが破棄されたとき (またはプロセス終了時) に解放する。
+    共有メモリに空きがない場合は、pickle 済みのデータを initializer の引数で各ワーカーに送る。
+    """
+    payload = pickle.dumps(
+        (
+            placeholders_for_skipping_replacements,
+            replacements_list_for_localized_string,
+            placeholders_for_localized_replacement,
+            replacements_final_list,
+            replacements_list_for_2char,
+            replacement_automaton,
+        ),
+        protocol=pickle.HIGHEST_PROTOCOL,
+    )
+    shm = None
+    if has_shared_memory_room(len(payload)):
+        try:
+            shm = SharedMemory(create=True, size=len(payload))
+        except OSError:
+            shm = None
+    if shm is not None:
+        shm.buf[:len(payload)] = payload
+        initargs = (shm.name, len(payload))
+    else:
+        initargs = (None, len(payload), payload)
+    executor = ProcessPoolExecutor(
+        max_workers=num_processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_replacement_worker,
+        initargs=initargs,
+    )
+    if shm is not None:
+        weakref.finalize(executor, _release_shared_memory, shm)
+    return executor
+
+# Linux の共有メモリ (POSIX shm) は /dev/shm の tmpfs に置かれる。
+# tmpfs はページを書き込んだ時点で確保するため、空きが足りないと SharedMemory の作成自体は成功し、
+# 書き込みの途中で SIGBUS が出てプロセス (Streamlit サーバー全体) が落ちる。
+# (Docker の既定の /dev/shm は 64MB で、既定のJSONの置換用データは 50MB 程度ある)
+SHARED_MEMORY_DIR = '/dev/shm'
+
+def has_shared_memory_room(size: int) -> bool:
+    """
+    共有メモリに size バイトを書き込めるだけの空きがあるかを返す。
+    /dev/shm がない環境 (macOS, Windows) では tmpfs の制限がないので True を返す。
+    """
+    if not hasattr(os, 'statvfs') or not os.path.isdir(SHARED_MEMORY_DIR):
+        return True
+    try:
+        stat = os.statvfs(SHARED_MEMORY_DIR)
+    except OSError:
+        return False
+    return stat.f_bavail * stat.f_frsize >= size
+
+def _release_shared_memory(shm: SharedMemory) -> None:
+    shm.close()
+    shm.unlink()
+
+def split_text_into_line_aligned_chunks(text: str, num_chunks: int) -> List[str]:
+    """
+    text を最大 num_chunks 個の、ほぼ等しい文字数のチャンクに分割する。
+    各チャンクの境界は改行の直後に合わせる (行のリストは作らない)。
+    """
+    chunk_size = max(len(text) // num_chunks, 1)
+    chunks = []
+    start = 0
+    while len(chunks) < num_chunks - 1:
+        newline_pos = text.find('\n', start + chunk_size - 1)
+        if newline_pos == -1 or newline_pos + 1 >= len(text):
+            break
+        chunks.append(text[start:newline_pos + 1])
+        start = newline_pos + 1
+    if start < len(text):
+        chunks.append(text[start:])
+    return chunks
+
 def parallel_process(
     text: str,
     num_processes: int,
     placeholders_for_skipping_replacements: List[str],
     replacements_list_for_localized_string: List[Tuple[str, str, str]],
     placeholders_for_localized_replacement: List[str],
-    replacements_final_list: List[Tuple[str, str, str]],
+    replacements_final_list: FinalReplacements,
     replacements_list_for_2char: List[Tuple[str, str, str]],
-    format_type: str
+    format_type: str,
+    replacement_automaton: Optional[ReplacementAutomaton] = None,
+    executor: Optional[ProcessPoolExecutor] = None
 ) -> str:
     """
-    与えられた text を行単位で分割し、process_segment を
+    与えられた text を行の境界でほぼ等しい文字数に分割し、process_segment を
     マルチプロセスで並列実行した結果を結合する。
+    executor (create_replacement_process_pool の戻り値) を渡すと、
+    そのワーカーが保持している置換用データを使い、送るのは分割したテキストだけになる。
     """
     if num_processes <= 1:
         # シングルコアで直接orchestrate_comprehensive_esperanto_text_replacementを呼ぶ
@@ -309,13 +777,14 @@ def parallel_process(
             placeholders_for_localized_replacement,
             replacements_final_list,
             replacements_list_for_2char,
-            format_type
+            format_type,
+            replacement_automaton
         )
 
-    # 行ごとに分割 (改行込み)
-    lines = re.findall(r'.*?\n|.+$', text)
-    num_lines = len(lines)
-    if num_lines <= 1:
+    # 行の途中で切らないように、ほぼ等しい文字数のチャンクに分割
+    # (置換ルールや %...% / @...@ は改行をまたがないので、改行の直後で切れば結果は変わらない)
+    chunks = split_text_into_line_aligned_chunks(text, num_processes)
+    if len(chunks) <= 1:
         # 行数が1以下なら並列化しても意味ないのでシングルで
         return orchestrate_comprehensive_esperanto_text_replacement(
             text,
@@ -324,28 +793,30 @@ def parallel_process(
             placeholders_for_localized_replacement,
             replacements_final_list,
             replacements_list_for_2char,
-            format_type
+            format_type,
+            replacement_automaton
         )
 
-    lines_per_process = max(num_lines // num_processes, 1)
-    ranges = [(i * lines_per_process, (i + 1) * lines_per_process) for i in range(num_processes)]
-    # 最後のプロセスに残りを全部割り当てる
-    ranges[-1] = (ranges[-1][0], num_lines)
+    if executor is not None:
+        results = executor.map(process_segment_in_worker, chunks, [format_type] * len(chunks))
+        return ''.join(results)
 
-    with multiprocessing.Pool(processes=num_processes) as pool:
+    # main.py を経由せずに呼ばれても fork しないよう、spawn を明示する
+    with multiprocessing.get_context("spawn").Pool(processes=num_processes) as pool:
         results = pool.starmap(
             process_segment,
             [
                 (
-                    lines[start:end],
+                    [chunk],
                     placeholders_for_skipping_replacements,
                     replacements_list_for_localized_string,
                     placeholders_for_localized_replacement,
                     replacements_final_list,
                     replacements_list_for_2char,
-                    format_type
+                    format_type,
+                    replacement_automaton
                 )
-                for (start, end) in ranges
+                for chunk in chunks
             ]
         )
     return ''.join(results)
@@ -356,6 +827,28 @@ def apply_ruby_html_header_and_footer(processed_text: str, format_type: str) ->
     指定された出力形式に応じて、processed_text に対するHTMLヘッダーとフッターを適用する。
     例: ルビサイズ調整用の<style> を挿入するなど。
     """
+    ruby_style_head, ruby_style_tail = get_ruby_html_header_and_footer(format_type)
+    return ''.join((ruby_style_head, processed_text, ruby_style_tail))
+
+def finalize_replacement_result(processed_text: str, format_type: str, letter_type: str) -> str:
+    """
+    置換結果 (letter_type 変換前) に、エスペラント特有文字の表記変換と
+    HTMLヘッダー・フッターの付加をまとめて行う。
+    (convert_esperanto_letter_type → apply_ruby_html_header_and_footer と同じ結果)
+    本文の走査は表記変換の1回だけで、ヘッダー・フッターは1回の join で付ける。
+    """
+    ruby_style_head, ruby_style_tail = get_ruby_html_header_and_footer(format_type)
+    return ''.join((
+        ruby_style_head,
+        convert_esperanto_letter_type(processed_text, letter_type),
+        ruby_style_tail,
+    ))
+
+def get_ruby_html_header_and_footer(format_type: str) -> Tuple[str, str]:
+    """
+    指定された出力形式に応じた (HTMLヘッダー, HTMLフッター) を返す。
+    HTML形式でなければどちらも空文字。
+    """
     if format_type in ('HTML格式_Ruby文字_大小调整','HTML格式_Ruby文字_大小调整_汉字替换'):
         # html形式におけるルビサイズの変更形式
         ruby_style_head="""<!DOCTYPE html>
@@ -471,4 +964,4 @@ ruby rt {
         ruby_style_head = ""
         ruby_style_tail = ""
     
-    return ruby_style_head + processed_text + ruby_style_tail
\ No newline at end of file
+    return ruby_style_head, ruby_style_tail
\ No newline at end of file
@@ -2,17 +2,19 @@
 # main.py (メインの Streamlit アプリ/機能拡充版202502)
 
 import streamlit as st
-import re
 import io
-import json
-import pandas as pd  # 必要なら使う
-from typing import List, Dict, Tuple, Optional
-import streamlit.components.v1 as components
+import os
+import pickle
+import ijson
+from typing import List, Dict, Tuple, Optional, BinaryIO, TypedDict
+# streamlit.components.v1 は HTML プレビューを表示するときだけ使うので、その分岐内で import する。
 import multiprocessing
+from concurrent.futures.process import BrokenProcessPool
 
 #=================================================================
 # Streamlit で multiprocessing を使う際、PicklingError 回避のため
 # 明示的に 'spawn' モードを設定する必要がある。
+# (JSON生成ページの並列処理も同じプロセスで動くので、並列処理の有無に関係なく設定する)
 #=================================================================
 try:
     multiprocessing.set_start_method("spawn")
@@ -25,47 +27,278 @@ except RuntimeError:
 # esp_text_replacement_module.py内に定義されているツールをまとめて呼び出す
 #=================================================================
 from esp_text_replacement_module import (
-    x_to_circumflex,
-    x_to_hat,
-    hat_to_circumflex,
-    circumflex_to_hat,
-    replace_esperanto_chars,
     import_placeholders,
     orchestrate_comprehensive_esperanto_text_replacement,
     parallel_process,
-    apply_ruby_html_header_and_footer
+    finalize_replacement_result,
+    build_replacement_automaton,
+    as_replacement_columns,
+    ReplacementColumns,
+    create_replacement_process_pool
 )
 
 #=================================================================
-# Streamlit の @st.cache_data デコレータを使い、読み込み結果をキャッシュして
+# 置換用JSONやプレースホルダのファイルパス
+#=================================================================
+DEFAULT_JSON_PATH = "./Appの运行に使用する各类文件/最终的な替换用リスト(列表)(合并3个JSON文件).json"
+PLACEHOLDERS_FOR_SKIPPING_PATH = './Appの运行に使用する各类文件/占位符(placeholders)_%1854%-%4934%_文字列替换skip用.txt'
+PLACEHOLDERS_FOR_LOCALIZED_PATH = './Appの运行に使用する各类文件/占位符(placeholders)_@5134@-@9728@_局部文字列替换结果捕捉用.txt'
+
+#=================================================================
+# Streamlit の @st.cache_resource デコレータを使い、読み込み結果をキャッシュして
 # JSONファイルのロード高速化を図る。大きなJSON(50MB程度)を都度読むと遅いので、
 # ここで呼び出す関数をキャッシュする作り。
+# @st.cache_data は呼び出しの度に戻り値(数百万要素のリスト)をコピー・ハッシュするため、
+# 参照をそのまま返す @st.cache_resource を使う。キーには (パス, 更新時刻) を渡し、
+# ファイルが更新されたときだけ読み直す。
+# ※ 戻り値は全セッションで共有されるので、呼び出し側で書き換えないこと。
 #=================================================================
-@st.cache_data
-def load_replacements_lists(json_path: str) -> Tuple[List, List, List]:
+@st.cache_resource
+def load_placeholders(placeholder_path: str, mtime: float) -> List[str]:
     """
-    JSONファイルをロードし、以下の3つのリストをタプルとして返す:
-    1) replacements_final_list
-    2) replacements_list_for_localized_string
-    3) replacements_list_for_2char
+    プレースホルダのテキストファイルを読み込む (mtime はキャッシュキー用)。
+    """
+    return import_placeholders(placeholder_path)
+
+def get_placeholders_mtimes() -> Tuple[float, float]:
+    """
+    プレースホルダ2種のファイルの更新時刻。置換用リストをまとめた dict のキャッシュキーに含め、
+    プレースホルダのファイルが更新されたときも読み直すようにする。
     """
-    with open(json_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    replacements_final_list = data.get(
-        "全域替换用のリスト(列表)型配列(replacements_final_list)", []
-    )
-    replacements_list_for_localized_string = data.get(
-        "局部文字替换用のリスト(列表)型配列(replacements_list_for_localized_string)", []
-    )
-    replacements_list_for_2char = data.get(
-        "二文字词根替换用のリスト(列表)型配列(replacements_list_for_2char)", []
-    )
     return (
-        replacements_final_list,
-        replacements_list_for_localized_string,
-        replacements_list_for_2char,
+        os.path.getmtime(PLACEHOLDERS_FOR_SKIPPING_PATH),
+        os.path.getmtime(PLACEHOLDERS_FOR_LOCALIZED_PATH),
     )
 
+# JSON内で置換用リストが格納されているキー
+REPLACEMENTS_JSON_KEYS = (
+    "全域替换用のリスト(列表)型配列(replacements_final_list)",
+    "局部文字替换用のリスト(列表)型配列(replacements_list_for_localized_string)",
+    "二文字词根替换用のリスト(列表)型配列(replacements_list_for_2char)",
+)
+
+# 読み込んだ置換用リストは、(old, new, placeholder) の tuple の tuple として持つ。
+# 読み込み後は書き換えないので、list より小さく、キャッシュしたオートマトン等と食い違う心配もない。
+# ※ 順番は JSON のまま (リストの順番がそのまま置換の優先順位なので、並べ替えない)。
+ReplacementRules = Tuple[Tuple[str, str, str], ...]
+
+# 置換用リスト3種とプレースホルダ2種をまとめた dict (キーの説明は load_replacements_bundle を参照)
+ReplacementsBundle = TypedDict("ReplacementsBundle", {
+    "final": ReplacementColumns,
+    "local": ReplacementRules,
+    "2char": ReplacementRules,
+    "skip_ph": List[str],
+    "local_ph": List[str],
+})
+
+def read_replacements_json(f: BinaryIO) -> Dict[str, ReplacementRules]:
+    """
+    置換用JSON (シーク可能なバイナリモードのファイルオブジェクト) を ijson で逐次パースし、
+    REPLACEMENTS_JSON_KEYS の3つの配列だけを取り出す。
+    配列ごとに先頭から読み直し、要素 [old, new, placeholder] を1件ずつ受け取ってすぐ tuple にするので、
+    json.load のように全体のオブジェクトツリー (他のキーの値も含む) を作ってからコピーすることがなく、
+    ピークメモリが半分以下になる。
+    """
+    data = {}
+    for key in REPLACEMENTS_JSON_KEYS:
+        f.seek(0)
+        data[key] = tuple(tuple(item) for item in ijson.items(f, f"{key}.item"))
+    return data
+
+#=================================================================
+# JSONをパースした結果は pickle の sidecar ファイルにも保存しておき、
+# 次回のコールドスタートではそちらを読む (JSONのパースより数倍速い)。
+# 形式を変えた場合は REPLACEMENTS_SIDECAR_VERSION を上げれば古い sidecar は無視される。
+#=================================================================
+REPLACEMENTS_SIDECAR_VERSION = 2
+
+def load_replacements_sidecar(sidecar_path: str) -> Optional[Dict[str, ReplacementRules]]:
+    """
+    sidecar を読み込む。存在しない・壊れている・バージョン違いの場合は None を返す。
+    """
+    try:
+        with open(sidecar_path, 'rb') as f:
+            payload = pickle.load(f)
+    except Exception:
+        return None
+    if not isinstance(payload, dict) or payload.get("version") != REPLACEMENTS_SIDECAR_VERSION:
+        return None
+    return payload["data"]
+
+def save_replacements_sidecar(sidecar_path: str, data: Dict[str, ReplacementRules]) -> None:
+    """
+    sidecar を一時ファイル経由で書き出す。書き込めない環境では何もしない。
+    """
+    tmp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(
+                {"version": REPLACEMENTS_SIDECAR_VERSION, "data": data},
+                f, protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(tmp_path, sidecar_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+def read_replacements_json_file(json_path: str) -> Dict[str, ReplacementRules]:
+    """
+    json_path + '.pkl' の sidecar が JSON より新しければそれを読み、
+    なければ JSON をパースして sidecar を作る。
+    """
+    sidecar_path = json_path + '.pkl'
+    if (os.path.exists(sidecar_path)
+            and os.path.getmtime(sidecar_path) >= os.path.getmtime(json_path)):
+        data = load_replacements_sidecar(sidecar_path)
+        if data is not None:
+            return data
+    with open(json_path, 'rb') as f:
+        data = read_replacements_json(f)
+    save_replacements_sidecar(sidecar_path, data)
+    return data
+
+def extract_replacements_lists(
+    data: Dict[str, ReplacementRules],
+    placeholders_mtimes: Tuple[float, float]
+) -> ReplacementsBundle:
+    """
+    JSONから読み込んだ dict から置換用リスト3種を取り出し、
+    プレースホルダ2種と合わせて1つの dict にまとめる。
+    30万件程度ある大域置換リストは、列ごとの形 (ReplacementColumns) にしておく。
+    """
+    skipping_mtime, localized_mtime = placeholders_mtimes
+    return {
+        "final": as_replacement_columns(data.get(REPLACEMENTS_JSON_KEYS[0], ())),
+        "local": data.get(REPLACEMENTS_JSON_KEYS[1], ()),
+        "2char": data.get(REPLACEMENTS_JSON_KEYS[2], ()),
+        "skip_ph": load_placeholders(PLACEHOLDERS_FOR_SKIPPING_PATH, skipping_mtime),
+        "local_ph": load_placeholders(PLACEHOLDERS_FOR_LOCALIZED_PATH, localized_mtime),
+    }
+
+@st.cache_resource
+def load_replacements_bundle(
+    json_path: str,
+    mtime: float,
+    placeholders_mtimes: Tuple[float, float]
+) -> ReplacementsBundle:
+    """
+    JSONファイルをロードし、以下をまとめた dict を返す
+    (mtime はキャッシュキー用、placeholders_mtimes は get_placeholders_mtimes の戻り値):
+    "final":    replacements_final_list (ReplacementColumns)
+    "local":    replacements_list_for_localized_string
+    "2char":    replacements_list_for_2char
+    "skip_ph":  placeholders_for_skipping_replacements
+    "local_ph": placeholders_for_localized_replacement
+    """
+    data = read_replacements_json_file(json_path)
+    return extract_replacements_lists(data, placeholders_mtimes)
+
+# アップロードされたJSONは sidecar をディスクに書かず、プロセス内でだけキャッシュする。
+# (共有の一時ディレクトリに置いた pickle は他のユーザーに差し替えられるおそれがあり、
+# アップロードごとに数十MBずつ溜まっていくため)
+# file_id はアップロードごとに変わるので、ウィジェット操作による再実行ではパースし直さない。
+@st.cache_resource(max_entries=2)
+def load_uploaded_replacements_bundle(
+    file_id: str,
+    placeholders_mtimes: Tuple[float, float],
+    _uploaded_file
+) -> ReplacementsBundle:
+    """
+    アップロードされたJSONをパースし、load_replacements_bundle と同じ形の dict を返す
+    (file_id はキャッシュキー用)。
+    """
+    data = read_replacements_json(io.BytesIO(_uploaded_file.getvalue()))
+    return extract_replacements_lists(data, placeholders_mtimes)
+
+#=================================================================
+# 大域置換用の Aho–Corasick オートマトンも @st.cache_resource で使い回す。
+# replacements_sig は置換用リスト3種の長さ + どのJSONかを表すキーで、
+# リストの中身をハッシュせずに「同じ置換用リストか」を判定するためのもの。
+# アップロードJSONでも、同じファイルである限り Submit の度に作り直さない。
+#=================================================================
+@st.cache_resource(max_entries=2)
+def get_replacement_automaton(replacements_sig: Tuple, _replacements_final_list: ReplacementColumns):
+    """
+    replacements_final_list から作った Aho–Corasick オートマトンを返す。
+    """
+    return build_replacement_automaton(_replacements_final_list)
+
+#=================================================================
+# 並列処理用のワーカープールも @st.cache_resource で使い回す。
+# ワーカーは起動時に置換用リストを1回だけ受け取るので、Submit の度に
+# プロセスを起動し直したり、置換用リストを pickle し直したりしなくて済む。
+# replacements_sig は置換用JSONが変わったことを判定するためのキー。
+# プールは常に MAX_PARALLEL_PROCESSES 個まで使える大きさで作る (spawn のプールは
+# 必要になった分しかワーカーを起動しないので、プロセス数を変えてもプールを作り直さなくてよい)。
+# 別々のJSONを使うセッションが交互に実行してもプールを作り直さないよう、2つまで保持する。
+# キャッシュから外れた古いプールは、参照が切れた時点でワーカーごと終了する。
+#=================================================================
+MAX_PARALLEL_PROCESSES = 4
+
+@st.cache_resource(max_entries=2)
+def get_replacement_process_pool(
+    replacements_sig: Tuple,
+    _replacements_bundle: ReplacementsBundle,
+    _replacement_automaton
+):
+    """
+    置換用データを読み込み済みのワーカープール (ProcessPoolExecutor) を返す。
+    """
+    return create_replacement_process_pool(
+        MAX_PARALLEL_PROCESSES,
+        _replacements_bundle["skip_ph"],
+        _replacements_bundle["local"],
+        _replacements_bundle["local_ph"],
+        _replacements_bundle["final"],
+        _replacements_bundle["2char"],
+        _replacement_automaton,
+    )
+
+#=================================================================
+# アップロードされた入力テキストのデコード
+# ウィジェットを操作する度に数MBのファイルをデコードし直さないよう、
+# file_id をキーにしてデコード結果を使い回す。(str は不変なので cache_resource で共有してよい。
+# cache_data だと取り出す度に pickle のコピーが走り、デコードと同程度のコストがかかる)
+#=================================================================
+@st.cache_resource(max_entries=4)
+def decode_uploaded_text(file_id: str, _raw_bytes: bytes) -> str:
+    """
+    アップロードされたテキストファイルを UTF-8 でデコードする (不正なバイトは置換文字にする)。
+    """
+    return _raw_bytes.decode("utf-8", errors="replace")
+
+#=================================================================
+# 置換結果のプレビュー
+# 長い結果は先頭 PREVIEW_HEAD_LINES 行と末尾 PREVIEW_TAIL_LINES 行だけを表示する。
+# splitlines() で全行のリストを作らず、改行の位置 (オフセット) だけを探して切り出す。
+#=================================================================
+MAX_PREVIEW_LINES = 250
+PREVIEW_HEAD_LINES = 247
+PREVIEW_TAIL_LINES = 3
+
+def build_result_preview(text: str) -> Tuple[str, int]:
+    """
+    (プレビュー用文字列, 行数) を返す。
+    行数が MAX_PREVIEW_LINES 以下ならプレビューは text そのもの。
+    """
+    line_count = text.count('\n')
+    if text and not text.endswith('\n'):
+        line_count += 1
+    if line_count <= MAX_PREVIEW_LINES:
+        return text, line_count
+
+    # 先頭から PREVIEW_HEAD_LINES 個目の改行の位置
+    head_end = -1
+    for _ in range(PREVIEW_HEAD_LINES):
+        head_end = text.find('\n', head_end + 1)
+    # 末尾の PREVIEW_TAIL_LINES 行の直前にある改行の位置 (末尾の改行は数えない)
+    tail_start = len(text) - 1 if text.endswith('\n') else len(text)
+    for _ in range(PREVIEW_TAIL_LINES):
+        tail_start = text.rfind('\n', 0, tail_start)
+    return text[:head_end] + "\n...\n" + text[tail_start + 1:], line_count
+
 #=================================================================
 # Streamlit ページの見た目設定
 # page_title: ブラウザタブに表示されるタイトル
@@ -97,10 +330,8 @@ selected_option = radio_json_options_display[selected_option_display]
 
 # Streamlit の折りたたみ (expander) でサンプルJSONのダウンロードを案内
 with st.expander("Sample JSON (Replacement JSON file)"):
-    # サンプルファイルのパス
-    json_file_path = './Appの运行に使用する各类文件/最终的な替换用リスト(列表)(合并3个JSON文件).json'
     # JSONファイルを読み込んでダウンロードボタンを生成
-    with open(json_file_path, "rb") as file_json:
+    with open(DEFAULT_JSON_PATH, "rb") as file_json:
         btn_json = st.download_button(
             label="Download the sample replacement JSON file",
             data=file_json,
@@ -109,21 +340,21 @@ with st.expander("Sample JSON (Replacement JSON file)"):
         )
 
 #=================================================================
-# 置換ルールとして使うリスト3種を初期化しておく。
+# 置換ルールとして使うリスト3種とプレースホルダ2種をまとめた dict。
 # (JSONファイル読み込み後に代入される)
 #=================================================================
-replacements_final_list: List[Tuple[str, str, str]] = []
-replacements_list_for_localized_string: List[Tuple[str, str, str]] = []
-replacements_list_for_2char: List[Tuple[str, str, str]] = []
+replacements_bundle: Optional[ReplacementsBundle] = None
+# どの置換用JSON・プレースホルダを読み込んだかを表すキー (replacements_sig の一部になる)
+replacements_key: Tuple = ()
 
 # JSONファイルの読み込み方を分岐
 if selected_option == "デフォルトを使用する":
-    default_json_path = "./Appの运行に使用する各类文件/最终的な替换用リスト(列表)(合并3个JSON文件).json"
     try:
-        # デフォルトJSONをロード
-        (replacements_final_list,
-         replacements_list_for_localized_string,
-         replacements_list_for_2char) = load_replacements_lists(default_json_path)
+        # デフォルトJSONをロード (更新時刻が変わらない限りキャッシュを再利用)
+        default_json_mtime = os.path.getmtime(DEFAULT_JSON_PATH)
+        placeholders_mtimes = get_placeholders_mtimes()
+        replacements_bundle = load_replacements_bundle(DEFAULT_JSON_PATH, default_json_mtime, placeholders_mtimes)
+        replacements_key = (DEFAULT_JSON_PATH, default_json_mtime) + placeholders_mtimes
         st.success("Successfully loaded the default JSON file.")
     except Exception as e:
         st.error(f"Failed to load the JSON file: {e}")
@@ -133,13 +364,11 @@ else:
     uploaded_file = st.file_uploader("Upload your replacement JSON file (合并3个JSON文件).json format)", type="json")
     if uploaded_file is not None:
         try:
-            combined_data = json.load(uploaded_file)
-            replacements_final_list = combined_data.get(
-                "全域替换用のリスト(列表)型配列(replacements_final_list)", [])
-            replacements_list_for_localized_string = combined_data.get(
-                "局部文字替换用のリスト(列表)型配列(replacements_list_for_localized_string)", [])
-            replacements_list_for_2char = combined_data.get(
-                "二文字词根替换用のリスト(列表)型配列(replacements_list_for_2char)", [])
+            placeholders_mtimes = get_placeholders_mtimes()
+            replacements_bundle = load_uploaded_replacements_bundle(
+                uploaded_file.file_id, placeholders_mtimes, uploaded_file
+            )
+            replacements_key = ("uploaded", uploaded_file.file_id) + placeholders_mtimes
             st.success("Successfully loaded the uploaded JSON file.")
         except Exception as e:
             st.error(f"Failed to load the uploaded JSON file: {e}")
@@ -149,15 +378,22 @@ else:
         st.stop()
 
 #=================================================================
-# 2) placeholders (占位符) の読み込み
-#    %...% や @...@ で囲った文字列を守るために使用する文字列群を読み込む
+# 2) placeholders (占位符) も bundle から取り出す
+#    %...% や @...@ で囲った文字列を守るために使用する文字列群
 #=================================================================
-placeholders_for_skipping_replacements: List[str] = import_placeholders(
-    './Appの运行に使用する各类文件/占位符(placeholders)_%1854%-%4934%_文字列替换skip用.txt'
-)
-placeholders_for_localized_replacement: List[str] = import_placeholders(
-    './Appの运行に使用する各类文件/占位符(placeholders)_@5134@-@9728@_局部文字列替换结果捕捉用.txt'
-)
+replacements_final_list: ReplacementColumns = replacements_bundle["final"]
+replacements_list_for_localized_string: ReplacementRules = replacements_bundle["local"]
+replacements_list_for_2char: ReplacementRules = replacements_bundle["2char"]
+placeholders_for_skipping_replacements: List[str] = replacements_bundle["skip_ph"]
+placeholders_for_localized_replacement: List[str] = replacements_bundle["local_ph"]
+
+# 置換用リストの同一性を表す軽量なシグネチャ (オートマトンとワーカープールのキャッシュキー)
+replacements_sig: Tuple = (
+    len(replacements_final_list.olds),
+    len(replacements_list_for_localized_string),
+    len(replacements_list_for_2char),
+) + replacements_key
+replacement_automaton = get_replacement_automaton(replacements_sig, replacements_final_list)
 
 st.write("---")
 
@@ -173,7 +409,7 @@ with st.expander("Open settings for parallel processing"):
     when performing text (Kanji) replacements.
     """)
     use_parallel = st.checkbox("Enable parallel processing", value=False)
-    num_processes = st.number_input("Number of parallel processes", min_value=2, max_value=4, value=4, step=1)
+    num_processes = st.number_input("Number of parallel processes", min_value=2, max_value=MAX_PARALLEL_PROCESSES, value=MAX_PARALLEL_PROCESSES, step=1)
 
 st.write("---")
 
@@ -201,9 +437,6 @@ selected_display = st.selectbox(
 )
 format_type = options[selected_display]
 
-# フォーム外で、変数 processed_text を初期化
-processed_text = ""
-
 #=================================================================
 # 4) 入力テキストのソースを選択 (手動入力 or ファイルアップロード)
 #=================================================================
@@ -224,7 +457,7 @@ uploaded_text = ""
 if source_option == "ファイルアップロード":
     text_file = st.file_uploader("Upload a text file (UTF-8)", type=["txt", "csv", "md"])
     if text_file is not None:
-        uploaded_text = text_file.read().decode("utf-8", errors="replace")
+        uploaded_text = decode_uploaded_text(text_file.file_id, text_file.getvalue())
         st.info("File has been loaded successfully.")
     else:
         st.warning("No file was uploaded. Please switch to manual input or upload a file.")
@@ -280,19 +513,37 @@ with st.form(key='profile_form'):
 
         #=================================================================
         # テキストを置換して処理 (並列 or 単一プロセス)
+        # letter_type 以外 (入力テキスト・出力形式・置換用JSON) が前回と同じなら、
+        # session_state に残しておいた letter_type 変換前の結果を再利用する。
+        # (文字表記だけ選び直した場合は、置換処理をやり直さずに済む)
         #=================================================================
-        if use_parallel:
-            processed_text = parallel_process(
-                text=text0,
-                num_processes=num_processes,
-                placeholders_for_skipping_replacements=placeholders_for_skipping_replacements,
-                replacements_list_for_localized_string=replacements_list_for_localized_string,
-                placeholders_for_localized_replacement=placeholders_for_localized_replacement,
-                replacements_final_list=replacements_final_list,
-                replacements_list_for_2char=replacements_list_for_2char,
-                format_type=format_type
-            )
-        else:
+        pre_letter_key = (hash(text0), format_type, replacements_sig)
+        processed_text = None
+        if st.session_state.get("pre_letter_key") == pre_letter_key:
+            processed_text = st.session_state["pre_letter_text"]
+        elif use_parallel:
+            try:
+                processed_text = parallel_process(
+                    text=text0,
+                    num_processes=num_processes,
+                    placeholders_for_skipping_replacements=placeholders_for_skipping_replacements,
+                    replacements_list_for_localized_string=replacements_list_for_localized_string,
+                    placeholders_for_localized_replacement=placeholders_for_localized_replacement,
+                    replacements_final_list=replacements_final_list,
+                    replacements_list_for_2char=replacements_list_for_2char,
+                    format_type=format_type,
+                    replacement_automaton=replacement_automaton,
+                    executor=get_replacement_process_pool(
+                        replacements_sig, replacements_bundle, replacement_automaton
+                    )
+                )
+            except BrokenProcessPool:
+                # ワーカーが異常終了した (メモリ不足など) プールは二度と使えないので、
+                # キャッシュから外して (次回の並列実行で作り直す)、今回は単一プロセスで処理する。
+                # 引数を渡して、このプールだけを外す (別のJSONを使うセッションのプールは残す)
+                get_replacement_process_pool.clear(replacements_sig, replacements_bundle, replacement_automaton)
+                st.warning("A parallel worker process stopped unexpectedly. Processing in a single process instead.")
+        if processed_text is None:
             processed_text = orchestrate_comprehensive_esperanto_text_replacement(
                 text=text0,
                 placeholders_for_skipping_replacements=placeholders_for_skipping_replacements,
@@ -300,46 +551,64 @@ with st.form(key='profile_form'):
                 placeholders_for_localized_replacement=placeholders_for_localized_replacement,
                 replacements_final_list=replacements_final_list,
                 replacements_list_for_2char=replacements_list_for_2char,
-                format_type=format_type
+                format_type=format_type,
+                replacement_automaton=replacement_automaton
             )
+        st.session_state["pre_letter_key"] = pre_letter_key
+        st.session_state["pre_letter_text"] = processed_text
 
         #=================================================================
-        # letter_typeの指定に応じて、最終的なエスペラント文字の表記を変換
+        # letter_typeの指定に応じて最終的なエスペラント文字の表記を変換し、
+        # HTML形式の場合はヘッダーとフッターをつける (ルビ表示対応)。
+        # 2つの後処理は finalize_replacement_result でまとめて1回で行う。
         #=================================================================
-        if letter_type == '上付き文字':
-            processed_text = replace_esperanto_chars(processed_text, x_to_circumflex)
-            processed_text = replace_esperanto_chars(processed_text, hat_to_circumflex)
-        elif letter_type == '^形式':
-            processed_text = replace_esperanto_chars(processed_text, x_to_hat)
-            processed_text = replace_esperanto_chars(processed_text, circumflex_to_hat)
+        processed_text = finalize_replacement_result(processed_text, format_type, letter_type)
 
-        # HTML形式の場合、ヘッダーとフッターをつける (ルビ表示対応)
-        processed_text = apply_ruby_html_header_and_footer(processed_text, format_type)
+        #=================================================================
+        # 結果は session_state に「UTF-8 バイト列 + 短いプレビュー」として残す。
+        # エンコードは Submit 時の1回だけで、ダウンロードにはそのバイト列を渡し、
+        # テキストエリアや HTML プレビューには切り詰めたプレビューだけを渡す。
+        #=================================================================
+        if processed_text:
+            preview_text, line_count = build_result_preview(processed_text)
+            st.session_state["replacement_result"] = {
+                "data": processed_text.encode('utf-8'),
+                "preview": preview_text,
+                "line_count": line_count,
+                "truncated": line_count > MAX_PREVIEW_LINES,
+                "format_type": format_type,
+            }
+        else:
+            st.session_state.pop("replacement_result", None)
 
 #=================================================================
 # フォーム外の処理: 結果表示・ダウンロード
+# @st.fragment にしておくと、タブの切り替えやダウンロードボタンなど
+# この部分のウィジェット操作では、この関数だけが再実行される
+# (JSONの読み込みやフォームの組み立てを含むスクリプト全体は再実行されない)。
+# 結果は session_state から読むので、Submit 後の全体の再実行では最新の結果が表示される。
 #=================================================================
-if processed_text:
-    MAX_PREVIEW_LINES = 250
-    lines = processed_text.splitlines()
-
-    if len(lines) > MAX_PREVIEW_LINES:
-        first_part = lines[:247]
-        last_part = lines[-3:]
-        preview_text = "\n".join(first_part) + "\n...\n" + "\n".join(last_part)
+@st.fragment
+def render_replacement_result() -> None:
+    replacement_result = st.session_state.get("replacement_result")
+    if not replacement_result:
+        return
+
+    preview_text = replacement_result["preview"]
+    if replacement_result["truncated"]:
         st.warning(
-            f"The text is quite long ({len(lines)} lines). "
-            "Preview is partially truncated. Showing the first 247 lines and the last 3 lines."
+            f"The text is quite long ({replacement_result['line_count']} lines). "
+            f"Preview is partially truncated. Showing the first {PREVIEW_HEAD_LINES} lines "
+            f"and the last {PREVIEW_TAIL_LINES} lines."
         )
-    else:
-        preview_text = processed_text
 
     #=================================================================
     # 置換結果の表示
     #=================================================================
-    if "HTML" in format_type:
+    if "HTML" in replacement_result["format_type"]:
         tab1, tab2 = st.tabs(["HTML Preview", "Replacement Result (HTML source)"])
         with tab1:
+            import streamlit.components.v1 as components
             components.html(preview_text, height=500, scrolling=True)
         with tab2:
             st.text_area("", preview_text, height=300)
@@ -348,14 +617,15 @@ if processed_text:
         with tab3_list[0]:
             st.text_area("", preview_text, height=300)
 
-    download_data = processed_text.encode('utf-8')
     st.download_button(
         label="Download the replacement result",
-        data=download_data,
+        data=replacement_result["data"],
         file_name="replacement_result.html",
         mime="text/html"
     )
 
+render_replacement_result()
+
 st.write("---")
 
 #=================================================================